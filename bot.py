@@ -1,10 +1,24 @@
 import logging
 import os
-import subprocess
 import asyncio
-from telegram import Update
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+from telegram import Message, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
+from telegram.error import TelegramError
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+
+try:
+    import uvloop
+except ImportError:  # opcional (não existe no Windows)
+    uvloop = None
 
 # Configura o logging para debug
 logging.basicConfig(
@@ -13,6 +27,151 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Diretório onde ficam as pastas temporárias de cada download. Se não for
+# definido, usa o diretório temporário do sistema.
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR")
+
+# Diretório opcional para os arquivos intermediários do yt-dlp (fragmentos,
+# partes antes do merge). Apontar para um tmpfs, como /dev/shm, tira esse I/O
+# do disco; só o arquivo final vai para a pasta do download.
+YTDLP_TEMP_DIR = os.getenv("YTDLP_TEMP_DIR")
+
+# Juntar vídeo e áudio separados exige o ffmpeg. A verificação é feita uma
+# única vez, ao carregar o módulo, e não a cada download.
+HAS_FFMPEG = shutil.which('ffmpeg') is not None
+
+# Opções fixas do yt-dlp: melhor formato de vídeo e áudio em MP4. Só o nome do
+# arquivo de saída muda a cada download. Sem ffmpeg, usa só formatos que já
+# vêm com vídeo e áudio juntos.
+YDL_OPTIONS = {
+    'format': (
+        'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        if HAS_FFMPEG else 'best[ext=mp4]/best'
+    ),
+    'merge_output_format': 'mp4',
+    'quiet': True,
+    'no_warnings': True,
+    # Baixa vários fragmentos (HLS/DASH) ao mesmo tempo
+    'concurrent_fragment_downloads': 8,
+}
+
+# Intervalo, em pontos percentuais, entre as atualizações de progresso
+PROGRESS_STEP = 10
+# Intervalo mínimo, em segundos, entre duas edições da mensagem de progresso
+PROGRESS_MIN_INTERVAL = 1.0
+
+# Cache (TTL + LRU) dos vídeos já enviados: link -> file_id do Telegram.
+# Quando um link é reenviado, o vídeo é reaproveitado sem baixar de novo.
+VIDEO_CACHE_TTL = 3600
+VIDEO_CACHE_MAX_SIZE = 512
+_video_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+def get_cached_video(url: str) -> Optional[str]:
+    """Retorna o file_id do vídeo já enviado para o link, se ainda for válido."""
+    entry = _video_cache.get(url)
+    if entry is None:
+        return None
+    stored_at, file_id = entry
+    if time.monotonic() - stored_at > VIDEO_CACHE_TTL:
+        del _video_cache[url]
+        return None
+    _video_cache.move_to_end(url)
+    return file_id
+
+def cache_video(url: str, file_id: str) -> None:
+    """Guarda o file_id do vídeo enviado, descartando os mais antigos."""
+    _video_cache[url] = (time.monotonic(), file_id)
+    _video_cache.move_to_end(url)
+    while len(_video_cache) > VIDEO_CACHE_MAX_SIZE:
+        _video_cache.popitem(last=False)
+
+def _last_line(error_message: str) -> str:
+    """Retorna a última linha da mensagem de erro do yt-dlp."""
+    # Procura a última quebra de linha a partir do fim, sem dividir a mensagem toda
+    error_message = error_message.rstrip()
+    return error_message[error_message.rfind('\n') + 1:].strip() or 'Erro desconhecido'
+
+async def _update_status(status_message: Message, text: str) -> None:
+    """Edita a mensagem de status, ignorando falhas (o progresso é opcional)."""
+    try:
+        await status_message.edit_text(text)
+    except TelegramError as e:
+        logger.debug("Não foi possível atualizar o progresso: %s", e)
+
+def _stream_label(info: dict) -> str:
+    """Indica se o formato sendo baixado é só o vídeo ou só o áudio."""
+    if info.get('vcodec') == 'none':
+        return ' o áudio'
+    if info.get('acodec') == 'none':
+        return ' o vídeo'
+    return ''
+
+def _make_progress_hook(loop: asyncio.AbstractEventLoop, status_message: Message) -> Callable[[dict], None]:
+    """Cria o hook de progresso do yt-dlp que atualiza a mensagem de status.
+
+    O hook roda nas threads do download, então a edição é agendada no loop de
+    eventos. Só atualiza a cada PROGRESS_STEP pontos percentuais e no máximo
+    uma vez a cada PROGRESS_MIN_INTERVAL segundos (exceto ao chegar em 100%),
+    para não esbarrar no limite de edições do Telegram.
+    """
+    # Com fragmentos simultâneos o hook é chamado por várias threads ao mesmo tempo
+    lock = threading.Lock()
+    last_key = None
+    last_step = -1
+    last_update = 0.0
+
+    def hook(status: dict) -> None:
+        nonlocal last_key, last_step, last_update
+        if status.get('status') != 'downloading':
+            return
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        if not total:
+            return
+        # Com bestvideo+bestaudio, vídeo e áudio são baixados separadamente: o
+        # progresso é acompanhado por formato e a mensagem diz qual está sendo baixado
+        info = status.get('info_dict') or {}
+        key = info.get('format_id') or status.get('filename')
+        percent = min(int(status.get('downloaded_bytes', 0) * 100 / total), 100)
+        step = percent // PROGRESS_STEP
+        with lock:
+            if key == last_key and step == last_step:
+                return
+            now = time.monotonic()
+            if percent < 100 and now - last_update < PROGRESS_MIN_INTERVAL:
+                return
+            last_key = key
+            last_step = step
+            last_update = now
+            asyncio.run_coroutine_threadsafe(
+                _update_status(status_message, f"Baixando{_stream_label(info)}... {percent}%"), loop
+            )
+
+    return hook
+
+def _download_video(url: str, work_dir: str, temp_dir: Optional[str], output_template: str,
+                    progress_hook: Callable[[dict], None]) -> Optional[str]:
+    """Baixa o vídeo usando o yt-dlp como biblioteca (bloqueante).
+
+    Retorna o caminho final do arquivo informado pelo próprio yt-dlp.
+    """
+    paths = {'home': work_dir}
+    if temp_dir:
+        paths['temp'] = temp_dir
+    options = {
+        **YDL_OPTIONS,
+        'paths': paths,
+        'outtmpl': output_template,
+        'progress_hooks': [progress_hook],
+    }
+    with YoutubeDL(options) as ydl:
+        info = ydl.extract_info(url, download=True)
+
+    # Em playlists, usa o primeiro vídeo baixado
+    for entry in (info or {}).get('entries') or [info]:
+        if entry and entry.get('requested_downloads'):
+            return entry['requested_downloads'][0]['filepath']
+    return None
+
 # Função para o comando /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Envia uma mensagem de boas-vindas quando o comando /start é emitido."""
@@ -24,79 +183,119 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # Função principal que lida com os links enviados
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Baixa o vídeo do link enviado pelo usuário."""
-    chat_id = update.message.chat_id
-    message_text = update.message.text
-    
-    # Avisa ao usuário que o processo começou
-    await context.bot.send_message(chat_id, text="Processando seu link...")
+    message = update.message
+    chat_id = message.chat_id
+    message_id = message.message_id
+    message_text = message.text
+
+    # Se o link foi baixado há pouco tempo, reenvia o vídeo que já está no Telegram
+    cached_file_id = get_cached_video(message_text)
+    if cached_file_id:
+        try:
+            await context.bot.send_video(chat_id, video=cached_file_id, supports_streaming=True)
+            logger.info("Vídeo reenviado a partir do cache: %s", message_text)
+            return
+        except Exception as e:
+            logger.warning("Falha ao reenviar vídeo do cache, baixando de novo: %s", e)
+            _video_cache.pop(message_text, None)
     
-    # Mostra a ação "enviando vídeo" no chat
-    await context.bot.send_chat_action(chat_id, action=ChatAction.UPLOAD_VIDEO)
+    # Avisa ao usuário que o processo começou e mostra a ação "enviando vídeo"
+    # no chat. As duas chamadas são independentes, então rodam em paralelo.
+    status_message, _ = await asyncio.gather(
+        context.bot.send_message(chat_id, text="Processando seu link..."),
+        context.bot.send_chat_action(chat_id, action=ChatAction.UPLOAD_VIDEO),
+    )
 
+    work_dir = temp_dir = None
     try:
+        # Cada download usa um diretório temporário próprio, removido ao final.
+        # Os arquivos intermediários do yt-dlp também ficam numa pasta só deste
+        # download, para que sobras de falhas não se acumulem no YTDLP_TEMP_DIR.
+        work_dir = tempfile.mkdtemp(prefix=f"dl_{chat_id}_{message_id}_", dir=DOWNLOAD_DIR)
+        if YTDLP_TEMP_DIR:
+            temp_dir = tempfile.mkdtemp(prefix=f"dl_{chat_id}_{message_id}_", dir=YTDLP_TEMP_DIR)
+
         # Define o nome do arquivo de saída. Usamos um nome fixo para facilitar.
-        output_template = f"{chat_id}_{update.message.message_id}.%(ext)s"
-        
-        # Comando yt-dlp para baixar o melhor formato de vídeo e áudio em MP4
-        command = [
-            'yt-dlp',
-            '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-            '--merge-output-format', 'mp4',
-            '-o', output_template,
-            message_text
-        ]
-
-        logger.info(f"Executando comando: {' '.join(command)}")
-        
-        # Executa o comando de forma assíncrona
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            # Encontra o nome do arquivo baixado
-            downloaded_file = None
-            for file in os.listdir('.'):
-                if file.startswith(f"{chat_id}_{update.message.message_id}"):
-                    downloaded_file = file
-                    break
-            
-            if downloaded_file:
-                logger.info(f"Download concluído: {downloaded_file}")
-                await context.bot.send_message(chat_id, text="Download finalizado! Enviando o vídeo...")
-                
-                # Envia o vídeo
-                with open(downloaded_file, 'rb') as video_file:
-                    await context.bot.send_video(chat_id, video=video_file, supports_streaming=True)
-                
-                # Apaga o arquivo do servidor para economizar espaço
-                os.remove(downloaded_file)
-                logger.info(f"Arquivo removido: {downloaded_file}")
-            else:
-                await context.bot.send_message(chat_id, text="Erro: não foi possível encontrar o arquivo baixado.")
-        else:
+        output_template = f"{chat_id}_{message_id}.%(ext)s"
+
+        # Baixa o melhor formato de vídeo e áudio em MP4. O yt-dlp roda no
+        # próprio processo, numa thread, sem o custo de iniciar um novo
+        # interpretador a cada link.
+        logger.info("Baixando vídeo: %s", message_text)
+        try:
+            progress_hook = _make_progress_hook(asyncio.get_running_loop(), status_message)
+            downloaded_file = await asyncio.to_thread(
+                _download_video, message_text, work_dir, temp_dir, output_template, progress_hook
+            )
+        except DownloadError as e:
             # Se der erro, informa o usuário e loga o erro
-            error_message = stderr.decode('utf-8', errors='ignore')
-            logger.error(f"Erro no yt-dlp: {error_message}")
-            await context.bot.send_message(chat_id, text=f"Desculpe, não consegui baixar o vídeo. Verifique o link ou tente um diferente.\nErro: {error_message.splitlines()[-1]}")
+            logger.error("Erro no yt-dlp: %s", e)
+            await context.bot.send_message(chat_id, text=f"Desculpe, não consegui baixar o vídeo. Verifique o link ou tente um diferente.\nErro: {_last_line(str(e))}")
+            return
+
+        if downloaded_file:
+            logger.info("Download concluído: %s", downloaded_file)
+            await context.bot.send_message(chat_id, text="Download finalizado! Enviando o vídeo...")
+
+            # Lê o vídeo numa thread para não travar o loop de eventos e o envia
+            video_data = await asyncio.to_thread(Path(downloaded_file).read_bytes)
+            sent = await context.bot.send_video(
+                chat_id,
+                video=video_data,
+                filename=os.path.basename(downloaded_file),
+                supports_streaming=True
+            )
+            if sent.video:
+                cache_video(message_text, sent.video.file_id)
+        else:
+            await context.bot.send_message(chat_id, text="Erro: não foi possível encontrar o arquivo baixado.")
 
     except Exception as e:
-        logger.error(f"Ocorreu um erro inesperado: {e}")
+        logger.error("Ocorreu um erro inesperado: %s", e)
         await context.bot.send_message(chat_id, text=f"Ocorreu um erro inesperado: {e}")
+    finally:
+        # Remove os diretórios numa thread para não travar o loop de eventos
+        for directory in (work_dir, temp_dir):
+            if directory:
+                await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+
+async def _log_event_loop(application: Application) -> None:
+    """Registra qual loop de eventos o bot está usando (uvloop ou o padrão)."""
+    loop = asyncio.get_running_loop()
+    logger.info("Loop de eventos em uso: %s.%s", type(loop).__module__, type(loop).__name__)
 
 def main() -> None:
     """Inicia o bot."""
+    # Usa o uvloop como loop de eventos, se estiver instalado. O run_polling cria
+    # o próprio loop, então trocar a política antes de tudo é a única forma de
+    # escolhê-lo (set_event_loop_policy está obsoleto a partir do Python 3.14).
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Pega o token da variável de ambiente
     token = os.getenv("TELEGRAM_TOKEN")
     if not token:
         raise ValueError("Token do Telegram não encontrado! Defina a variável de ambiente TELEGRAM_TOKEN.")
 
-    # Cria a aplicação do bot
-    application = Application.builder().token(token).build()
+    for directory in (DOWNLOAD_DIR, YTDLP_TEMP_DIR):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    if not HAS_FFMPEG:
+        logger.warning("ffmpeg não encontrado: os vídeos serão baixados sem juntar vídeo e áudio separados.")
+
+    # Cria a aplicação do bot. Requisições com arquivos usam o media_write_timeout
+    # (e não o write_timeout); ele e o timeout de leitura são maiores que o padrão
+    # para que o upload de vídeos grandes não seja interrompido.
+    application = (
+        Application.builder()
+        .token(token)
+        .pool_timeout(10)
+        .read_timeout(60)
+        .media_write_timeout(60)
+        .post_init(_log_event_loop)
+        .build()
+    )
 
     # Adiciona os handlers (comandos e mensagens)
     application.add_handler(CommandHandler("start", start))